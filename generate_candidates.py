@@ -1,14 +1,16 @@
 #!/usr/bin/env python3
-import os, sys, time, traceback
-import pandas as pd
+import hashlib, io, os, random, sys, time, traceback
 import requests
+from requests.adapters import HTTPAdapter
 from pathlib import Path
 
 # --- nieuw ---
-import csv, tempfile, unicodedata, re  # voor veilig CSV schrijven & sanitizing
+import csv, operator, tempfile, unicodedata, re  # voor veilig CSV schrijven & sanitizing
 
-LIMIT = int(os.environ.get("LIMIT", "200"))
+LIMIT = 10  # vast, zoals in de oorspronkelijke query; de LIMIT-env wordt (nog) niet gebruikt
 SANITIZE = bool(int(os.environ.get("SANITIZE", "1")))  # 1 = schoonmaken aan (default)
+CACHE_TTL = float(os.environ.get("CACHE_TTL", "3600"))  # seconden; 0 = cache uit
+CACHE_DIR = Path("data") / ".cache"
 
 QUERY = """
 PREFIX wd:   <http://www.wikidata.org/entity/>
@@ -30,30 +32,22 @@ SELECT
   ?collectieLabel
   ?floruit
 WHERE {
+  # kern: de items zelf + hun referentie (objectsoort/titel), één rij per item
   {
     SELECT
       ?item
-      (SAMPLE(?objectsoort) AS ?objectsoort)
-      (SAMPLE(?objecttitel) AS ?objecttitel)
-      (SAMPLE(?werkloc0)    AS ?werklocatie)
-      (SAMPLE(?beroep0)     AS ?beroep)
-      (SAMPLE(?collectie0)  AS ?collectie)
-      (SAMPLE(?fy0)         AS ?floruit)
+      (SAMPLE(?objectsoort0) AS ?objectsoort)
+      (SAMPLE(?objecttitel0) AS ?objecttitel)
     WHERE {
       BIND(RAND() AS ?sortKey)
       ?item wdt:P6379 wd:Q1616123 ;
             wdt:P31  wd:Q5 .
 
-      OPTIONAL { ?item wdt:P1317 ?floruit1 . BIND(YEAR(?floruit1) AS ?fy0) }
-      OPTIONAL { ?item wdt:P937  ?werkloc0. }
-      OPTIONAL { ?item wdt:P106  ?beroep0. }
-      OPTIONAL { ?item wdt:P6379 ?collectie0. }
-
       ?item p:P6379 [
         ps:P6379 wd:Q1616123 ;
         prov:wasDerivedFrom [
-          pr:P3865 ?objectsoort ;
-          pr:P1476 ?objecttitel
+          pr:P3865 ?objectsoort0 ;
+          pr:P1476 ?objecttitel0
         ]
       ] .
       FILTER NOT EXISTS {?item wdt:P7763 []}
@@ -61,12 +55,37 @@ WHERE {
     }
     GROUP BY ?item
   }
+  # per property een eigen subselect (al per item geaggregeerd) i.p.v. één OPTIONAL-kruisproduct;
+  # de P6379-triple begrenst elke scan tot de items van deze collectie
+  OPTIONAL {
+    SELECT ?item (SAMPLE(?fy0) AS ?floruit)
+    WHERE { ?item wdt:P6379 wd:Q1616123 ; wdt:P1317 ?floruit1 . BIND(YEAR(?floruit1) AS ?fy0) }
+    GROUP BY ?item
+  }
+  OPTIONAL {
+    SELECT ?item (SAMPLE(?werkloc0) AS ?werklocatie)
+    WHERE { ?item wdt:P6379 wd:Q1616123 ; wdt:P937 ?werkloc0 . }
+    GROUP BY ?item
+  }
+  OPTIONAL {
+    SELECT ?item (SAMPLE(?beroep0) AS ?beroep)
+    WHERE { ?item wdt:P6379 wd:Q1616123 ; wdt:P106 ?beroep0 . }
+    GROUP BY ?item
+  }
+  OPTIONAL {
+    SELECT ?item (SAMPLE(?collectie0) AS ?collectie)
+    WHERE { ?item wdt:P6379 wd:Q1616123 , ?collectie0 . }
+    GROUP BY ?item
+  }
   SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],mul,nl,en". }
 }
 ORDER BY ?sortKey
-LIMIT 10
 """
 
+def build_query(limit: int = LIMIT) -> str:
+    # QUERY zelf bevat geen LIMIT; pas hier plakken we hem eraan
+    return QUERY + f"LIMIT {limit}\n"
+
 UA = os.environ.get(
     "WDQS_USER_AGENT",
     "CopyClear-SPARQL/0.2 (+https://github.com/<user>/<repo>; https://www.wikidata.org/wiki/User:CopyClear)"
@@ -74,102 +93,241 @@ UA = os.environ.get(
 WDQS_URL = "https://query.wikidata.org/sparql"
 HEADERS = {
     "User-Agent": UA,
-    "Accept": "application/sparql-results+json"
+    "Accept": "text/csv",  # SPARQL CSV-resultaten: kleiner dan JSON en direct door de C-parser
+    "Accept-Encoding": "gzip, deflate",  # WDQS comprimeert; requests pakt transparant uit
 }
 
-def run_query(query: str, tries=5, backoff=2.0):
+# Eén gedeelde sessie: keep-alive hergebruikt de TLS-verbinding over retries en queries heen
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0)  # retries doen we zelf
+SESSION.mount("https://", _adapter)
+SESSION.headers.update(HEADERS)
+
+def retry_delay(r: requests.Response, attempt: int, backoff: float) -> float:
+    # Retry-After van WDQS (seconden) gaat voor; anders exponentieel. Plus jitter, max 60 s.
+    try:
+        delay = float(r.headers.get("Retry-After", ""))
+    except ValueError:
+        delay = backoff * (2 ** attempt)
+    return min(delay + random.uniform(0, 0.5), 60.0)
+
+# goedkope ASK (één triple-lookup) om te zien of WDQS überhaupt antwoordt
+PING_QUERY = "PREFIX wd: <http://www.wikidata.org/entity/> PREFIX wdt: <http://www.wikidata.org/prop/direct/> ASK { wd:Q42 wdt:P31 wd:Q5 }"
+
+def wdqs_up(tries=2, timeout=5) -> bool:
+    # fail fast: liever na ~10 s een lege CSV dan 5 × 60 s wachten op een dode endpoint
+    for i in range(tries):
+        try:
+            r = SESSION.get(
+                WDQS_URL, params={"query": PING_QUERY}, timeout=timeout,
+                headers={"Accept": "application/sparql-results+json"},  # ASK heeft geen CSV-vorm
+            )
+            r.close()
+            if r.status_code == 200:
+                return True
+            print(f"[WARN] WDQS ping HTTP {r.status_code} (attempt {i+1}/{tries})", file=sys.stderr)
+        except requests.RequestException as e:
+            print(f"[WARN] WDQS ping faalde: {e} (attempt {i+1}/{tries})", file=sys.stderr)
+    return False
+
+def run_query(query: str, tries=5, backoff=2.0) -> requests.Response:
+    # stream=True: body wordt pas gelezen tijdens het itereren, zodat schrijven al begint
+    # terwijl WDQS nog aan het sturen is; de caller sluit de response
     for i in range(tries):
-        r = requests.get(WDQS_URL, params={"query": query}, headers=HEADERS, timeout=60)
+        r = SESSION.get(WDQS_URL, params={"query": query}, timeout=60, stream=True)
         if r.status_code == 200:
-            return r.json()
-        # WDQS geeft soms 400 bij throttling; body bevat hint
+            return r
+        # 429/503 = throttling/overbelast: zeker opnieuw proberen (Retry-After respecteren)
         print(f"[WARN] WDQS HTTP {r.status_code} (attempt {i+1}/{tries})", file=sys.stderr)
         try:
             print(r.text[:1000], file=sys.stderr)
         except Exception:
             pass
-        time.sleep(backoff * (i+1))
+        r.close()
+        if r.status_code == 400:
+            # malformed query: opnieuw proberen helpt niet
+            raise RuntimeError("WDQS HTTP 400: query geweigerd")
+        if i + 1 < tries:
+            time.sleep(retry_delay(r, i, backoff))
     raise RuntimeError(f"WDQS failed after {tries} attempts")
 
-def json_to_df(data: dict) -> pd.DataFrame:
-    rows = []
-    for b in data.get("results", {}).get("bindings", []):
-        row = {}
-        for k, v in b.items():
-            row[k] = v.get("value")
-        rows.append(row)
-    return pd.DataFrame(rows)
-
-def qid_from_uri(u: str) -> str:
-    return u.rsplit('/', 1)[-1] if isinstance(u, str) and u.startswith('http') else u
-
 # --- nieuw: sanitizing + veilig (atomic) CSV schrijven ---
 COLUMNS = [
     "item","objecttitel","itemLabel","objectsoortLabel",
     "beroepLabel","collectieLabel","floruit","werklocatieLabel","qid"
 ]
+SPARQL_KEYS = tuple(COLUMNS[:-1])  # wat we uit het SPARQL-resultaat halen, al in uitvoervolgorde
+
+def response_lines(r: requests.Response):
+    # body als tekststroom, incrementeel gelezen van de socket; gzip wordt onderweg uitgepakt
+    r.raw.decode_content = True
+    r.raw.auto_close = False  # anders markeert urllib3 de stream als gesloten zodra de body op is
+    return io.TextIOWrapper(r.raw, encoding="utf-8", newline="")
+
+def query_lines(query: str):
+    # CSV-regels van het resultaat: uit data/.cache als die vers genoeg is, anders van WDQS.
+    # Bij een WDQS-run gaat elke regel meteen ook naar de cache; pas als de hele body
+    # binnen is wordt het cachebestand (atomair) zichtbaar.
+    # CACHE_TTL <= 0: cache helemaal uit, dus ook niets wegschrijven
+    cache = CACHE_DIR / f"{hashlib.sha256(query.encode('utf-8')).hexdigest()}.csv"
+    if CACHE_TTL > 0:
+        try:
+            if time.time() - cache.stat().st_mtime < CACHE_TTL:
+                print(f"[OK] cache-hit → {cache}")
+                with open(cache, encoding="utf-8", newline="") as f:
+                    yield from f
+                return
+        except FileNotFoundError:
+            pass
+    if not wdqs_up():
+        raise RuntimeError("WDQS reageert niet op ping; SELECT overgeslagen")
+    if CACHE_TTL <= 0:
+        with run_query(query) as r:
+            yield from response_lines(r)
+        return
+    prune_cache()
+    with run_query(query) as r:
+        # de cache is een optimalisatie: gaat het wegschrijven mis (read-only data/, schijf vol),
+        # dan alleen de cache laten vallen en de regels gewoon doorgeven
+        f = tmp_name = None
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(dir=str(CACHE_DIR), suffix=".tmp")
+            f = os.fdopen(fd, "w", encoding="utf-8", newline="")
+        except OSError as e:
+            f = drop_cache_tmp(f, tmp_name, e)
+        try:
+            for line in response_lines(r):
+                if f is not None:
+                    try:
+                        f.write(line)
+                    except OSError as e:
+                        f = drop_cache_tmp(f, tmp_name, e)
+                yield line
+        except BaseException:
+            if f is not None:
+                drop_cache_tmp(f, tmp_name)
+            raise
+    if f is not None:
+        try:
+            f.close()
+            os.replace(tmp_name, cache)
+        except OSError as e:
+            drop_cache_tmp(f, tmp_name, e)
+
+def drop_cache_tmp(f, tmp_name, err=None):
+    # half geschreven cachebestand opruimen; fouten hierbij zijn niet meer interessant
+    if err is not None:
+        print(f"[WARN] cache niet geschreven: {err}", file=sys.stderr)
+    if f is not None:
+        try:
+            f.close()
+        except OSError:
+            pass
+    if tmp_name is not None:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+    return None
+
+def prune_cache():
+    # verlopen cache-entries (en tmp-restanten van afgebroken runs) weggooien
+    now = time.time()
+    for p in list(CACHE_DIR.glob("*.csv")) + list(CACHE_DIR.glob("*.tmp")):
+        try:
+            if now - p.stat().st_mtime >= CACHE_TTL:
+                p.unlink()
+        except OSError:
+            pass
+
+def iter_bindings(lines):
+    # SPARQL CSV-resultaat → één tuple per rij in SPARQL_KEYS-volgorde (unbound = "")
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return
+    # kolomposities één keer bepalen; per rij is het dan één itemgetter-aanroep
+    pos = {k: i for i, k in enumerate(header)}
+    yield from map(operator.itemgetter(*(pos[k] for k in SPARQL_KEYS)), reader)
+
+# line/paragraph separators, CR/LF/tab → spatie
+_WS_RE = re.compile(r"[\t\n\r\u2028\u2029]+")
+# overige control-chars (C0, DEL, C1) → weg
+_CTRL_RE = re.compile(r"[\x00-\x08\x0b-\x1f\x7f-\x9f]+")
+# onzichtbare format-chars (soft hyphen, zero-width, LRM/RLM, word joiner, BOM) → weg
+_INVISIBLE_RE = re.compile(r"[\u00ad\u200b-\u200f\u2060\ufeff]+")
+_MULTI_WS = re.compile(r"\s+")
 
 def sanitize_text(s: str) -> str:
-    if not isinstance(s, str):
-        return s
+    # cellen zijn altijd str (unbound = ""), dus geen NaN/None-check nodig
     s = unicodedata.normalize("NFC", s)
-    # vervang line/paragraph separators, CR/LF/tab door spaties
-    s = s.replace("\u2028", " ").replace("\u2029", " ").replace("\r", " ").replace("\n", " ").replace("\t", " ")
-    # niet-printbare control-chars eruit (behalve spatie)
-    s = "".join(ch for ch in s if ch.isprintable() or ch == " ")
-    # collapse whitespace
-    s = re.sub(r"\s+", " ", s)
-    return s.strip()
-
-def prepare_df(df: pd.DataFrame) -> pd.DataFrame:
-    if df.empty:
-        return pd.DataFrame(columns=COLUMNS)
-    if "item" in df.columns:
-        df["qid"] = df["item"].apply(qid_from_uri)
-    # zorg dat alle verwachte kolommen er zijn
-    for col in COLUMNS:
-        if col not in df.columns:
-            df[col] = ""
-    # sanitizen tekstvelden
-    if SANITIZE:
-        for col in ["objecttitel","itemLabel","objectsoortLabel","beroepLabel","collectieLabel","werklocatieLabel"]:
-            if col in df.columns:
-                df[col] = df[col].map(sanitize_text)
-    # volgorde + NaN -> lege string
-    df = df[COLUMNS].fillna("")
-    return df
-
-def safe_write_csv(df: pd.DataFrame, out_path: Path):
+    s = _WS_RE.sub(" ", s)
+    s = _CTRL_RE.sub("", s)
+    s = _INVISIBLE_RE.sub("", s)
+    # vangnet voor de rest (bidi-controls, private use, unassigned, ...): isprintable() is C,
+    # alleen de zeldzame vuile cel betaalt de per-teken-loop
+    if not s.isprintable():
+        s = "".join(ch for ch in s if ch.isprintable() or ch == " ")
+    return _MULTI_WS.sub(" ", s).strip()
+
+TEXT_COLUMNS = {"objecttitel","itemLabel","objectsoortLabel","beroepLabel","collectieLabel","werklocatieLabel"}
+
+def write_rows(bindings, out_path: Path, sanitize: bool = SANITIZE) -> int:
+    # rechtstreeks met csv.writer naar schijf; geen DataFrame ertussen
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    df = prepare_df(df)
-    # atomic write: eerst naar tmp, dan replace
-    with tempfile.NamedTemporaryFile("w", delete=False, encoding="utf-8", newline="") as tmp:
-        tmp_name = tmp.name
-        df.to_csv(
-            tmp,
-            index=False,
-            header=True,
-            sep=",",
-            quoting=csv.QUOTE_ALL,   # forceer quotes: bestand blijft valide als er komma's/aanhalingstekens/\n in velden zitten
-            doublequote=True,
-            lineterminator="\n",
-        )
+    clean = [i for i, c in enumerate(SPARQL_KEYS) if sanitize and c in TEXT_COLUMNS]
+    n = 0
+    # atomic write: eerst naar tmp (zelfde map, zodat os.replace niet over filesystems gaat), dan replace.
+    # Eén grote buffer (4 MiB) i.p.v. de default 8 KiB: een handvol write()-syscalls per run.
+    fd, tmp_name = tempfile.mkstemp(dir=str(out_path.parent), suffix=".tmp")
+    os.fchmod(fd, 0o644)  # mkstemp maakt 0600; candidates.csv hoort gewoon leesbaar te zijn
+    try:
+        with os.fdopen(fd, "w", buffering=4 * 1024 * 1024, encoding="utf-8", newline="") as f:
+            writer = csv.writer(
+                f,
+                # geschoonde velden bevatten geen \r/\n meer: dan volstaan quotes waar nodig. Zonder
+                # sanitizing alles quoten; csv.writer quote een losse \r anders niet (lineterminator "\n").
+                quoting=csv.QUOTE_MINIMAL if sanitize else csv.QUOTE_ALL,
+                doublequote=True,
+                lineterminator="\n",
+            )
+            writer.writerow(COLUMNS)
+            for vals in bindings:
+                row = list(vals)
+                for i in clean:
+                    row[i] = sanitize_text(row[i])
+                item = row[0]
+                row.append(item.rpartition("/")[2] if item.startswith("http") else item)
+                writer.writerow(row)
+                n += 1
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
     os.replace(tmp_name, out_path)
+    return n
 
-def main():
-    out = Path("data") / "candidates.csv"
+def run(query: str, outfile: Path, sanitize: bool = SANITIZE) -> int:
+    # één query → één CSV; bij een fout een lege CSV met juiste kolommen zodat de workflow door kan
     try:
-        data = run_query(QUERY)
-        df = json_to_df(data)
-        safe_write_csv(df, out)
-        print(f"[OK] {len(df)} resultaten → {out}")
+        n = write_rows(iter_bindings(query_lines(query)), outfile, sanitize)
+        print(f"[OK] {n} resultaten → {outfile}")
+        return n
     except Exception as e:
         print("[ERROR] SPARQL faalde:", e, file=sys.stderr)
         traceback.print_exc()
-        # Schrijf lege CSV met juiste kolommen zodat de workflow door kan
-        empty = pd.DataFrame(columns=COLUMNS)
-        safe_write_csv(empty, out)
-        print(f"[WARN] Lege CSV geschreven → {out}")
+        write_rows([], outfile, sanitize)
+        print(f"[WARN] Lege CSV geschreven → {outfile}")
+        return 0
+
+def run_many(jobs) -> list:
+    # meerdere (query, outfile[, sanitize])-jobs in één proces: alles gaat over dezelfde SESSION (keep-alive)
+    return [run(*job) for job in jobs]
+
+def main():
+    run(build_query(), Path("data") / "candidates.csv")
 
 if __name__ == "__main__":
     main()